@@ -1,14 +1,24 @@
 import pandas as pd
 import streamlit as st
 from docx import Document
+from docx.oxml.ns import qn
 import os
 import re
+import struct
 import sys
 import zipfile
 import io
 import tempfile
 import datetime
+import importlib.util
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+
+# Excel读取引擎：优先使用calamine（比openpyxl读取更快、内存占用更低），
+# 未安装时回退到pandas默认引擎（xlsx由openpyxl以只读模式读取）
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
 
 # 设置页面标题
 st.set_page_config(page_title="文档批量生成工具", layout="wide")
@@ -23,113 +33,293 @@ if 'generated_files' not in st.session_state:
     st.session_state.generated_files = []
 if 'filename_template' not in st.session_state:
     st.session_state.filename_template = ""
+if 'zip_bytes' not in st.session_state:
+    st.session_state.zip_bytes = b""
 
 # 占位符处理器
 class PlaceholderHandler:
     """占位符处理器，支持多种占位符格式"""
-    PLACEHOLDER_PATTERNS = [
-        r'\{\{\s*(.*?)\s*\}\}',  # {{key}}
-        r'\$\{\s*(.*?)\s*\}',    # ${key}
-        r'\{\s*(.*?)\s*\}',      # {key}
-        r'\[\[\s*(.*?)\s*\]\]'   # [[key]]
-    ]
+    # 四种格式合并为一个正则，每段文本只需扫描一次；
+    # 键中不允许出现任何格式的定界符：匹配失败时不会越过下一个括号回溯，扫描保持线性，
+    # 写在括号里的占位符（如"{[[key]]}"）也不会被外层括号整体吞掉
+    COMBINED_PATTERN = re.compile(
+        r'\{\{\s*(?P<k>[^{}\[\]\n]*?)\s*\}\}'       # {{key}}
+        r'|\$\{\s*(?P<k2>[^{}\[\]\n]*?)\s*\}'       # ${key}
+        r'|\{\s*(?P<k3>[^{}\[\]\n]*?)\s*\}'         # {key}
+        r'|\[\[\s*(?P<k4>[^{}\[\]\n]*?)\s*\]\]'     # [[key]]
+    )
 
     @classmethod
     def find_placeholders(cls, text: str) -> list:
         """查找文本中的所有占位符"""
-        placeholders = []
-        for pattern in cls.PLACEHOLDER_PATTERNS:
-            matches = re.findall(pattern, text)
-            placeholders.extend(matches)
-        return list(set(placeholders))
+        placeholders = {
+            match.group(match.lastindex)
+            for match in cls.COMBINED_PATTERN.finditer(text)
+        }
+        return list(placeholders)
+
+    @classmethod
+    def substitute(cls, text: str, replacements: dict) -> str:
+        """一次扫描替换文本中的所有占位符，未知占位符保持原样"""
+        def _lookup(match):
+            key = match.group(match.lastindex)
+            if key in replacements:
+                return str(replacements[key])
+            return match.group(0)
+        return cls.COMBINED_PATTERN.sub(_lookup, text)
+
+    @classmethod
+    def placeholder_spans(cls, text: str, keys, offset: int = 0) -> set:
+        """返回文本中指定键的占位符位置集合{(开始, 结束)}，位置加上offset"""
+        return {
+            (offset + match.start(), offset + match.end())
+            for match in cls.COMBINED_PATTERN.finditer(text)
+            if match.group(match.lastindex) in keys
+        }
 
     @classmethod
     def replace_placeholder(cls, text: str, placeholder: str, value: str) -> str:
         """替换特定格式的占位符"""
-        for pattern in cls.PLACEHOLDER_PATTERNS:
-            wrapped_placeholder = pattern.replace(r'(.*?)', re.escape(placeholder))
-            if re.search(wrapped_placeholder, text):
-                text = re.sub(wrapped_placeholder, str(value), text)
-        return text
-
-def replace_text_in_paragraph(paragraph, replacements: dict):
-    """替换段落中的占位符，保留原有格式"""
-    all_placeholders = []
-    
-    # 检查段落中是否包含任何占位符
-    for key in replacements:
-        for pattern in PlaceholderHandler.PLACEHOLDER_PATTERNS:
-            wrapped_key = pattern.replace(r'(.*?)', re.escape(key))
-            if re.search(wrapped_key, paragraph.text):
-                all_placeholders.append(key)
-                break
+        return cls.substitute(text, {placeholder: value})
+
+def merge_placeholder_runs(paragraph, keys):
+    """占位符跨run时将段落合并为一个run，保证每个占位符完整位于同一个<w:t>中"""
+    # 获取段落的完整文本（合并所有run）
+    full_text = ''.join([run.text for run in paragraph.runs])
     
-    if not all_placeholders:
+    # 快速排除不含占位符定界符的段落（所有格式都包含'{'或'['）
+    if '{' not in full_text and '[' not in full_text:
         return
     
-    # 获取段落的完整文本（合并所有run）
-    full_text = ''.join([run.text for run in paragraph.runs])
+    paragraph_spans = PlaceholderHandler.placeholder_spans(full_text, keys)
+    if not paragraph_spans:
+        return
     
-    # 替换所有占位符
-    for placeholder in all_placeholders:
-        value = replacements.get(placeholder, '')
-        for pattern in PlaceholderHandler.PLACEHOLDER_PATTERNS:
-            wrapped_placeholder = pattern.replace(r'(.*?)', re.escape(placeholder))
-            full_text = re.sub(wrapped_placeholder, str(value), full_text)
+    # 计算每个<w:t>文本在完整文本中的起始位置，并找出各<w:t>内部单独匹配到的占位符；
+    # 两者位置完全一致时，每个占位符都完整位于单个<w:t>中，无需合并，保留各run的原有格式
+    text_node_spans = set()
+    run_offset = 0
+    for run in paragraph.runs:
+        run_text = run.text
+        node_pos = 0
+        for text_node in run.element.findall(qn('w:t')):
+            node_text = text_node.text or ''
+            node_pos = run_text.find(node_text, node_pos)
+            if node_pos < 0:
+                break
+            text_node_spans |= PlaceholderHandler.placeholder_spans(
+                node_text, keys, run_offset + node_pos
+            )
+            node_pos += len(node_text)
+        run_offset += len(run_text)
+    if text_node_spans == paragraph_spans:
+        return
     
-    # 清空原有runs并添加新文本
+    # 清空原有runs，完整文本写入第一个run
     for run in paragraph.runs:
         run.text = ""
     
-    if paragraph.runs:
-        paragraph.runs[0].text = full_text
-    else:
-        paragraph.add_run(full_text)
+    paragraph.runs[0].text = full_text
 
-def process_document(template_path: str, output_path: str, replacements: dict) -> bool:
-    """处理整个Word文档的替换"""
-    try:
-        doc = Document(template_path)
-        
-        # 处理正文段落
-        for paragraph in doc.paragraphs:
-            replace_text_in_paragraph(paragraph, replacements)
+def iter_document_paragraphs(doc: Document):
+    """依次返回正文、表格、页眉和页脚中的所有段落"""
+    # 正文段落
+    yield from doc.paragraphs
+    
+    # 表格
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                yield from cell.paragraphs
+    
+    # 页眉和页脚
+    for section in doc.sections:
+        yield from section.header.paragraphs
+        yield from section.footer.paragraphs
+
+class DocxTemplate:
+    """预处理后的Word模板
+
+    模板只用python-docx解析一次：占位符跨run的段落先合并为单个run，
+    之后把各个XML部件缓存下来，逐行生成时不再解析和修改XML树。
+    正文、页眉、页脚XML在预处理时按占位符位置切分为固定片段和占位符槽位，
+    逐行生成时只需把替换值和固定片段拼接起来，再重新打包。
+    其余部件（样式、字体、主题、图片等）在预处理时就压缩好，
+    打包时直接复用压缩结果，只有替换过的XML需要重新压缩。
+    """
+    # 需要替换占位符的XML部件
+    TEXT_PART_PATTERN = re.compile(r'word/(document|header\d*|footer\d*)\.xml')
+    # <w:t>元素及其文本
+    TEXT_NODE_PATTERN = re.compile(r'<w:t(?:\s[^>]*)?>([^<]*)</w:t>')
+    # ZIP文件头中的修改时间和日期（DOS格式，1980-01-01 00:00）
+    ZIP_DOS_TIME = 0
+    ZIP_DOS_DATE = (1 << 5) | 1
+    # XML 1.0中不允许出现的字符（除制表符和换行外的控制字符等）
+    ILLEGAL_XML_CHAR_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+    # 与python-docx设置run文本时一致：制表符转为<w:tab/>，\r和\n各转为一个<w:br/>
+    SPECIAL_CHAR_PATTERN = re.compile('[\t\r\n]')
+    SPECIAL_CHAR_XML = {
+        '\t': '</w:t><w:tab/><w:t xml:space="preserve">',
+        '\r': '</w:t><w:br/><w:t xml:space="preserve">',
+        '\n': '</w:t><w:br/><w:t xml:space="preserve">',
+    }
+
+    def __init__(self, template_bytes: bytes, keys):
+        self.keys = frozenset(keys)
+        doc = Document(io.BytesIO(template_bytes))
+        for paragraph in iter_document_paragraphs(doc):
+            merge_placeholder_runs(paragraph, keys)
         
-        # 处理表格
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        replace_text_in_paragraph(paragraph, replacements)
+        buffer = io.BytesIO()
+        doc.save(buffer)
         
-        # 处理页眉
-        for section in doc.sections:
-            for paragraph in section.header.paragraphs:
-                replace_text_in_paragraph(paragraph, replacements)
+        # 各部件按原顺序保存：(文件名, 切分后的XML, 预压缩数据)
+        # 不含占位符的部件和其他部件一样直接预压缩
+        self.parts = []
+        with zipfile.ZipFile(buffer) as zip_file:
+            for name in zip_file.namelist():
+                data = zip_file.read(name)
+                if self.TEXT_PART_PATTERN.fullmatch(name):
+                    compiled = self._compile_xml(data.decode('utf-8'))
+                    if compiled[1]:
+                        self.parts.append((name, compiled, None))
+                        continue
+                self.parts.append((name, None, self._compress(data)))
+
+    def _compile_xml(self, xml: str) -> tuple:
+        """按占位符位置切分XML，返回(固定片段列表, 占位符槽位列表)
+
+        固定片段比槽位多一个，槽位为(键, 占位符原文)，两者交替拼接即得到替换后的XML。
+        只切分<w:t>文本中属于self.keys的占位符，其余内容原样保留在固定片段中。
+        """
+        # XML中的文本是转义过的，按转义后的键匹配
+        escaped_keys = {escape(str(key)): key for key in self.keys}
+        literals = []
+        slots = []
+        pending = []
+        last_end = 0
+        for node in self.TEXT_NODE_PATTERN.finditer(xml):
+            text = node.group(1)
+            if '{' not in text and '[' not in text:
+                continue
+            matches = [
+                match for match in PlaceholderHandler.COMBINED_PATTERN.finditer(text)
+                if match.group(match.lastindex) in escaped_keys
+            ]
+            if not matches:
+                continue
             
-            # 处理页脚
-            for paragraph in section.footer.paragraphs:
-                replace_text_in_paragraph(paragraph, replacements)
+            # 替换值可能以空格开头或结尾，统一保留空白
+            pending += [xml[last_end:node.start()], '<w:t xml:space="preserve">']
+            text_pos = 0
+            for match in matches:
+                pending.append(text[text_pos:match.start()])
+                literals.append(''.join(pending))
+                pending = []
+                slots.append((escaped_keys[match.group(match.lastindex)], match.group(0)))
+                text_pos = match.end()
+            pending += [text[text_pos:], '</w:t>']
+            last_end = node.end()
         
-        doc.save(output_path)
-        return True
-    except Exception as e:
-        st.error(f"处理文档时发生错误: {str(e)}")
-        return False
+        pending.append(xml[last_end:])
+        literals.append(''.join(pending))
+        return literals, slots
+
+    @staticmethod
+    def _compress(data: bytes) -> tuple:
+        """压缩单个部件，返回(CRC32, 压缩后数据, 原始大小)"""
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        return zlib.crc32(data), compressed, len(data)
+
+    @classmethod
+    def _build_zip(cls, entries: list) -> bytes:
+        """用已压缩的部件拼装ZIP文件，entries为(文件名, (CRC32, 压缩后数据, 原始大小))"""
+        chunks = []
+        central_directory = []
+        offset = 0
+        for name, (crc, compressed, size) in entries:
+            name_bytes = name.encode('utf-8')
+            fields = (
+                20, 0x800, zipfile.ZIP_DEFLATED, cls.ZIP_DOS_TIME, cls.ZIP_DOS_DATE,
+                crc, len(compressed), size, len(name_bytes), 0
+            )
+            local_header = struct.pack('<4s5HLLLHH', b'PK\x03\x04', *fields)
+            central_directory.append(
+                struct.pack('<4sH5HLLLHHHHHLL', b'PK\x01\x02', 20, *fields, 0, 0, 0, 0, offset)
+                + name_bytes
+            )
+            chunks += [local_header, name_bytes, compressed]
+            offset += len(local_header) + len(name_bytes) + len(compressed)
+        
+        central_directory = b''.join(central_directory)
+        end_record = struct.pack(
+            '<4s4HLLH', b'PK\x05\x06', 0, 0,
+            len(entries), len(entries), len(central_directory), offset, 0
+        )
+        chunks += [central_directory, end_record]
+        return b''.join(chunks)
+
+    @classmethod
+    def _xml_text(cls, value) -> str:
+        """将替换值转换为可直接写入<w:t>的XML文本，换行和制表符转换为对应元素
+
+        值中含有XML不允许的控制字符时抛出ValueError，该行按生成失败处理。
+        """
+        text = str(value)
+        if cls.ILLEGAL_XML_CHAR_PATTERN.search(text):
+            raise ValueError(f"替换值中包含Word文档不支持的控制字符: {text!r}")
+        return cls.SPECIAL_CHAR_PATTERN.sub(
+            lambda match: cls.SPECIAL_CHAR_XML[match.group(0)], escape(text)
+        )
+
+    @staticmethod
+    def _fill_xml(compiled: tuple, values: dict) -> str:
+        """将替换值填入切分后的XML，缺少的键保留占位符原文"""
+        literals, slots = compiled
+        # 用切片赋值交替放入固定片段和替换值，避免逐个append
+        chunks = [None] * (len(literals) + len(slots))
+        chunks[::2] = literals
+        chunks[1::2] = [values.get(key, placeholder) for key, placeholder in slots]
+        return ''.join(chunks)
+
+    def render(self, replacements: dict) -> bytes:
+        """生成一行数据对应的文档内容"""
+        # 只转换模板中出现的键，仅用于文件名的列不受正文字符限制
+        values = {key: self._xml_text(replacements[key]) for key in self.keys if key in replacements}
+        
+        # 只有需要替换的XML重新压缩，其余部件直接使用预压缩数据
+        entries = []
+        for name, compiled, compressed in self.parts:
+            if compiled is not None:
+                compressed = self._compress(self._fill_xml(compiled, values).encode('utf-8'))
+            entries.append((name, compressed))
+        return self._build_zip(entries)
+
+def process_document(template: DocxTemplate, output_path: str, replacements: dict) -> bytes:
+    """处理整个Word文档的替换
+
+    文档在内存中生成，再一次性写入output_path，并返回文档内容，
+    供调用方直接打包，无需再读回磁盘。
+    可在工作线程中调用，出错时直接抛出异常，由主线程负责显示错误信息。
+    """
+    data = template.render(replacements)
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return data
+
+# 文件名中的非法字符（用于str.translate删除）
+ILLEGAL_FILENAME_CHARS = str.maketrans('', '', '\\/*?:"<>|')
 
 def generate_output_filename(row: dict, filename_template: str) -> str:
     """使用模板生成输出文件名"""
     filename = filename_template
     
     # 替换模板中的占位符
-    for key, value in row.items():
-        for pattern in PlaceholderHandler.PLACEHOLDER_PATTERNS:
-            wrapped_key = pattern.replace(r'(.*?)', re.escape(key))
-            if re.search(wrapped_key, filename):
-                filename = re.sub(wrapped_key, str(value), filename)
+    filename = PlaceholderHandler.substitute(filename, row)
     
     # 移除非法字符
-    filename = re.sub(r'[\\/*?:"<>|]', "", filename).strip()
+    filename = filename.translate(ILLEGAL_FILENAME_CHARS).strip()
     
     # 确保文件名以.docx结尾
     if not filename.lower().endswith('.docx'):
@@ -137,6 +327,36 @@ def generate_output_filename(row: dict, filename_template: str) -> str:
     
     return filename
 
+def make_unique_filename(filename: str, index: int, used_filenames: set) -> str:
+    """文件名与之前的行重复时追加行号后缀（不区分大小写），避免多个任务写入同一文件"""
+    stem, ext = os.path.splitext(filename)
+    candidate, suffix = filename, index + 1
+    while candidate.lower() in used_filenames:
+        candidate = f"{stem}_{suffix}{ext}"
+        suffix += 1
+    used_filenames.add(candidate.lower())
+    return candidate
+
+# 缓存最近几次上传的文件即可，避免长期运行的服务内存无限增长
+CACHE_MAX_ENTRIES = 4
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_excel(excel_bytes: bytes) -> list:
+    """读取Excel数据（保留单元格原始值，只在用到时再转换为字符串），按文件内容缓存"""
+    df = pd.read_excel(io.BytesIO(excel_bytes), dtype=object, engine=EXCEL_ENGINE)
+    return df.to_dict('records')
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_template(template_bytes: bytes, columns: tuple) -> tuple:
+    """检查并预处理Word模板，返回(模板中的占位符, DocxTemplate)，按文件内容和Excel列缓存"""
+    template_doc = Document(io.BytesIO(template_bytes))
+    template_text = "\n".join([p.text for p in iter_document_paragraphs(template_doc)])
+    template_placeholders = PlaceholderHandler.find_placeholders(template_text)
+    
+    # 预处理模板，只保留Excel中存在的占位符
+    template_keys = set(template_placeholders) & set(columns)
+    return template_placeholders, DocxTemplate(template_bytes, template_keys)
+
 # 文件上传区域
 st.header("1. 上传文件")
 
@@ -162,59 +382,80 @@ if st.button("开始生成文档") and excel_file and template_file:
     st.session_state.output_dir = os.path.join(temp_dir, "生成文档")
     os.makedirs(st.session_state.output_dir, exist_ok=True)
     
-    # 保存上传的文件
-    excel_path = os.path.join(temp_dir, excel_file.name)
-    with open(excel_path, "wb") as f:
-        f.write(excel_file.getbuffer())
-    
-    template_path = os.path.join(temp_dir, template_file.name)
-    with open(template_path, "wb") as f:
-        f.write(template_file.getbuffer())
-    
     # 处理Excel数据
     try:
         # 读取Excel
-        df = pd.read_excel(excel_path).astype(str)
+        records = load_excel(excel_file.getvalue())
+        columns = tuple(records[0]) if records else ()
         
         # 生成文档
         progress_bar = st.progress(0)
         status_text = st.empty()
         generated_files = []
         
-        total_rows = len(df)
+        total_rows = len(records)
         success_count = 0
         
-        # 检查模板中的占位符
-        template_doc = Document(template_path)
-        template_text = "\n".join([p.text for p in template_doc.paragraphs])
-        template_placeholders = PlaceholderHandler.find_placeholders(template_text)
+        # 检查并预处理模板
+        template_placeholders, template = load_template(template_file.getvalue(), columns)
         
         # 显示占位符信息
         st.info(f"模板中包含以下占位符: {', '.join(template_placeholders)}")
         
-        for index, row in df.iterrows():
-            # 更新进度
-            progress = (index + 1) / total_rows
-            progress_bar.progress(progress)
-            status_text.text(f"正在处理 {index+1}/{total_rows}...")
-            
-            # 准备替换数据
-            replacements = row.to_dict()
-            
-            # 生成文件名
-            output_filename = generate_output_filename(replacements, filename_template)
-            output_path = os.path.join(st.session_state.output_dir, output_filename)
+        # 模板和文件名中用到的列，只有这些列需要转换为字符串
+        used_keys = template.keys | set(PlaceholderHandler.find_placeholders(filename_template))
+        
+        # 各行文档相互独立，并行生成；生成完成的文档直接写入ZIP包
+        # （只在生成时打包一次，页面重新运行时直接复用）
+        # docx本身已经是压缩过的ZIP，打包时不再重复压缩
+        zip_buffer = io.BytesIO()
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor, \
+                zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_STORED, False) as zip_file:
+            futures = {}
+            used_filenames = set()
+            for index, row in enumerate(records):
+                # 准备替换数据（空单元格为空字符串）
+                replacements = {
+                    k: '' if pd.isna(v) else str(v)
+                    for k, v in row.items() if k in used_keys
+                }
+                
+                # 生成文件名（重名时加后缀，保证每个任务写入不同的文件）
+                output_filename = make_unique_filename(
+                    generate_output_filename(replacements, filename_template), index, used_filenames)
+                output_path = os.path.join(st.session_state.output_dir, output_filename)
+                
+                # 提交文档处理任务
+                future = executor.submit(process_document, template, output_path, replacements)
+                futures[future] = (index, output_filename, output_path)
             
-            # 处理文档
-            if process_document(template_path, output_path, replacements):
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                # 更新进度
+                progress_bar.progress(done_count / total_rows)
+                status_text.text(f"正在处理 {done_count}/{total_rows}...")
+                
+                # 取出后不再引用该任务，已写入ZIP的文档内容可以及时释放
+                index, output_filename, output_path = futures.pop(future)
+                try:
+                    data = future.result()
+                except Exception as e:
+                    st.error(f"处理文档时发生错误: {str(e)}")
+                    continue
+                
+                zip_file.writestr(output_filename, data)
                 success_count += 1
                 generated_files.append({
+                    "index": index,
                     "name": output_filename,
                     "path": output_path
                 })
         
+        # 按Excel行顺序排列结果
+        generated_files.sort(key=lambda file_info: file_info["index"])
+        
         # 保存结果
         st.session_state.generated_files = generated_files
+        st.session_state.zip_bytes = zip_buffer.getvalue()
         st.session_state.processing_stage = 1
         st.session_state.filename_template = filename_template
         
@@ -231,19 +472,10 @@ if st.button("开始生成文档") and excel_file and template_file:
 if st.session_state.processing_stage == 1 and st.session_state.generated_files:
     st.header("3. 下载生成的文件")
     
-    # 创建ZIP文件
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        for file_info in st.session_state.generated_files:
-            if os.path.exists(file_info["path"]):
-                zip_file.write(file_info["path"], file_info["name"])
-    
-    zip_buffer.seek(0)
-    
     # 提供下载按钮
     st.download_button(
         label=f"下载所有文档 (ZIP)",
-        data=zip_buffer,
+        data=st.session_state.zip_bytes,
         file_name="generated_documents.zip",
         mime="application/zip",
         key="download_all_zip"
@@ -276,6 +508,7 @@ if st.button("重置系统", key="reset_button"):
     st.session_state.output_dir = ""
     st.session_state.generated_files = []
     st.session_state.filename_template = ""
+    st.session_state.zip_bytes = b""
     
     st.success("系统已重置，可以开始新的处理流程！")
     st.experimental_rerun()